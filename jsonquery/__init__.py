@@ -1,319 +1,1018 @@
+import functools
+import operator
 import os.path
 import typing
 from lxml import etree
 import io
-from collections import Counter
+from collections import deque
 import json
+from xml.sax.saxutils import escape
 
 from multiprocessing import Lock
 
+# Prefer a faster JSON parser when one is on hand - orjson and ujson parse the same documents
+# several times faster than the standard library and hand back the same dicts and lists.
+# Neither offers a streaming load, so files are read fully and fed through loads
+try:
+    import orjson as _json
+except ImportError:
+    try:
+        import ujson as _json
+    except ImportError:
+        _json = json
+
+
+import collections.abc as abstract_collections
+
+# Try to import numpy; if it's available, cool, we can use some of its functionality.
+# If not, we can just carry on
+try:
+    import numpy
+
+    def numpy_is_available() -> bool:
+        return True
+except ImportError as e:
+    def numpy_is_available() -> bool:
+        return False
+
+# Same deal for ijson - with it we can stream files straight into the tree builder,
+# without it we just fall back to loading the whole document through json
+try:
+    import ijson
+
+    def ijson_is_available() -> bool:
+        return True
+except ImportError as e:
+    def ijson_is_available() -> bool:
+        return False
 
 _INIT_LOCK = Lock()
 
 
-def init() -> typing.NoReturn:
+@functools.lru_cache(maxsize=256)
+def _compiled_xpath(path: str) -> etree.XPath:
     """
-    Builds functions for querying json files and attaches them to lxml's etree
+    Compiles an xpath expression, reusing the compiled form on repeat queries
+
+    lxml parses and compiles the expression on every tree.xpath(path) call; callers tend to issue
+    the same expression over and over, so pay the compile cost once per distinct path instead
+
+    :param path: The xpath expression to compile
+    :return: The compiled, reusable form of the expression
     """
-    # lock modification so (hopefully) nothing goofy happens out of order
-    with _INIT_LOCK:
-        # Go ahead and return if all these functions have already been created - our work is done here
-        if hasattr(etree, "from_json") \
-                and hasattr(etree, "from_json_file") \
-                and hasattr(etree, 'query_from_json') \
-                and hasattr(etree, 'query_from_json_file'):
-            return
-
-        import collections.abc as abstract_collections
-
-        # Try to import numpy; if it's available, cool, we can use some of its functionality.
-        # If not, we can just carry on
-        try:
-            import numpy
-
-            def numpy_is_available() -> bool:
-                return True
-        except ImportError as e:
-            def numpy_is_available() -> bool:
-                return False
-
-        def _is_slotted(value: typing.Any) -> bool:
-            """
-            Indicates whether the given value is an object that stores its members as slot members instead of the __dict__
-            :param value: The value to test
-            :return: whether the given value is an object that stores its members as slot members instead of the __dict__
-            """
-            # Classes that use __slots__ and classes that use __dict__ are mutually exclusive -
-            # if this value has __slots__, the keys for its members are in __slots__, not __dict__
-            return hasattr(value, "__slots__")
-
-        def _is_container(value: typing.Any) -> bool:
-            """
-            Indicates whether the given value is a container for other values
-
-            `bytes` and `str` are both considered containers by traditional means. One stores bytes,
-            the other stores characters. As a result, those are specifically excluded.
-
-            :param value: The value to test
-            :return: True if the value implements the Container base class and is not a str or bytes, False otherwise
-            """
-            # `bytes`
-            return not isinstance(value, str) \
-                   and not isinstance(value, bytes) \
-                   and isinstance(value, abstract_collections.Container)
-
-        def _is_basic_value(value: typing.Any) -> bool:
-            """
-            Indicates whether a value may be considered a single, atomic value and not a composite value
-            (like an object) or a container
-
-            :param value: The value to test
-            :return: True if the value is not a composite value or a container, False otherwise
-            """
-            return not hasattr(value, "__dict__") and not _is_slotted(value) and not _is_container(value)
-
-        def _build_element(key: str, value: typing.Any) -> typing.Iterable[etree.ElementBase]:
-            """
-            Constructs a sequence of XML elements based on a key-value pair
-
-            :param key: The name of a presumed JSON node that contained the passed value
-            :param value: The core value alluded to by the key within the JSON document
-            :return: A sequence of all recursively created XML elements
-            """
-            elements: typing.List[etree.ElementBase] = list()
-
-            if _is_basic_value(value):
-                # If the value is atomic, we can make a simple xml element and move on
-                element = etree.Element(key)
-                element.set("datatype", type(value).__name__)
-                element.set("list_member", str(False))
-                element.text = str(value)
-                elements.append(element)
-            elif isinstance(value, abstract_collections.Mapping):
-                # The passed in value was a JSON object - we'll need to translate that into a more complex xml mapping
-                """
-                ```
-                "key": {
-                    "object1": 3,
-                    "object2": [
-                        3,
-                        5,
-                        6
-                    ],
-                    "object3": {
-                        "object4": 5,
-                        "object5": [
-                            1,
-                            2
-                            3
-                        ],
-                        "object6": "word"
-                    }
-                }
-                ```
-                
-                should end up looking like:
-                
-                ```
-                <key>
-                    <object1 datatype="int" list_member="false">3</object1>
-                    <object2 datatype="int" list_member="true" index="0">3</object2>
-                    <object2 datatype="int" list_member="true" index="1">5</object2>
-                    <object2 datatype="int" list_member="true" index="3">6</object2>
-                    <object3 datatype="dict" list_member="false">
-                        <object4 datatype="int" list_member="false">5</object4>
-                        <object5 datatype="int" list_member="true" index="0">1</object5>
-                        <object5 datatype="int" list_member="true" index="1">2</object5>
-                        <object5 datatype="int" list_member="true" index="2">3</object5>
-                        <object6 datatype="str" list_member="false">word</object6>
-                    </object3>
-                </key>
-                ```
-                """
-                element = etree.Element(key)
-                element.set("datatype", type(value).__name__)
-                element.set("list_member", str(False))
-
-                # Count encountered names - if they are encountered multiple times, we probably have a list
-                # that needs to be accounted for since this will recurse through children
-                found_keys = Counter()
-                found_nodes = list()
-
-                # Create xml tags for all elements held within the map
-                for sub_key, sub_value in value.items():
-                    sub_elements = _build_element(sub_key, sub_value)
-                    for node in sub_elements:
-                        # Make sure that the name of the tag is noted, the count is incremented,
-                        # and the node is added to the outer list
-                        found_keys[node.tag] += 1
-                        found_nodes.append(node)
-
-                key_indices = Counter()
-                for node in found_nodes:
-                    if found_keys[node.tag] > 1:
-                        node.set('list_member', str(True))
-                        node.set('index', str(key_indices[node.tag]))
-                        key_indices[node.tag] += 1
-                    element.append(node)
-                elements.append(element)
-            elif _is_container(value):
-                list_index = 0
-                for sub_value in value:
-                    for element in _build_element(key, sub_value):
-                        element.set("list_member", str(True))
-                        element.set("index", str(list_index))
-                        elements.append(element)
-                    list_index += 1
-            elif hasattr(value, "__dict__"):
-                element = etree.Element(key)
-                element.set("datatype", type(value).__name__)
-                element.set("list_member", str(False))
-                for sub_key, sub_value in value.__dict__.items():
-                    if isinstance(sub_value, typing.Callable):
-                        continue
-                    nodes = _build_element(sub_key, sub_value)
+    return etree.XPath(path)
 
-                    for node in nodes:
-                        element.append(node)
 
-                elements.append(element)
-            elif _is_slotted(value):
-                keys: typing.Iterable[str] = value.__slots__
-                element = etree.Element(key)
-                element.set("datatype", type(value).__name__)
-                element.set("list_member", str(False))
+def _is_slotted(value: typing.Any) -> bool:
+    """
+    Indicates whether the given value is an object that stores its members as slot members instead of the __dict__
+    :param value: The value to test
+    :return: whether the given value is an object that stores its members as slot members instead of the __dict__
+    """
+    # Classes that use __slots__ and classes that use __dict__ are mutually exclusive -
+    # if this value has __slots__, the keys for its members are in __slots__, not __dict__
+    return hasattr(value, "__slots__")
 
-                for slotted_variable in keys:
-                    value = getattr(value, slotted_variable)
 
-                    if isinstance(value, typing.Callable):
-                        continue
+def _is_container(value: typing.Any) -> bool:
+    """
+    Indicates whether the given value is a container for other values
+
+    `bytes` and `str` are both considered containers by traditional means. One stores bytes,
+    the other stores characters. As a result, those are specifically excluded.
+
+    :param value: The value to test
+    :return: True if the value implements the Container base class and is not a str or bytes, False otherwise
+    """
+    # `bytes`
+    return not isinstance(value, str) \
+           and not isinstance(value, bytes) \
+           and isinstance(value, abstract_collections.Container)
+
+
+# The concrete types that json.load can hand back for atomic values. Checking membership here is a
+# single hash lookup, whereas the hasattr/isinstance ladder below has to probe attributes and walk
+# ABC registries for every single node
+_BASIC_TYPES = frozenset((str, bytes, int, float, bool, type(None)))
+
+
+# Stringified attribute values that would otherwise be rebuilt for every single node
+_FALSE = str(False)
+_TRUE = str(True)
+
+
+# A type's name never changes, so pay for the __name__ lookup once per type rather than once
+# per node. Prefilled with everything json.load can produce; anything else lands lazily
+_TYPENAME_CACHE: typing.Dict[type, str] = {
+    int: "int",
+    float: "float",
+    str: "str",
+    bool: "bool",
+    dict: "dict",
+    list: "list",
+    type(None): "NoneType",
+}
+
+
+# Every list member interpolates its position into an attribute; the first few thousand index
+# strings cover nearly all real documents, so format each of them exactly once
+_SMALL_INTS = [str(i) for i in range(4096)]
+
+
+# Opening tags for non-list members depend only on the tag and datatype, and closing tags only
+# on the tag - both repeat constantly in real documents, so build and UTF-8 encode each
+# distinct fragment a single time
+_START_TAG_CACHE: typing.Dict[typing.Tuple[str, str], bytes] = {}
+_CLOSE_TAG_CACHE: typing.Dict[str, bytes] = {}
+
+
+def _index_text(position: int) -> str:
+    """
+    Renders a list position, reusing preformatted strings for small values
+
+    :param position: The position to render
+    :return: The position as a string
+    """
+    return _SMALL_INTS[position] if position < 4096 else str(position)
+
+
+def _closing_tag(key: str) -> bytes:
+    """
+    Renders the encoded closing tag for an element, reusing it across repeats of the tag
+
+    :param key: The tag for the element
+    :return: The encoded closing tag
+    """
+    closing = _CLOSE_TAG_CACHE.get(key)
+
+    if closing is None:
+        closing = _CLOSE_TAG_CACHE.setdefault(key, f'</{key}>'.encode("utf-8"))
+
+    return closing
+
+
+def _is_basic_value(value: typing.Any) -> bool:
+    """
+    Indicates whether a value may be considered a single, atomic value and not a composite value
+    (like an object) or a container
+
+    :param value: The value to test
+    :return: True if the value is not a composite value or a container, False otherwise
+    """
+    if type(value) in _BASIC_TYPES:
+        return True
+    return not hasattr(value, "__dict__") and not _is_slotted(value) and not _is_container(value)
+
+
+# Marker placed on the work stack beneath a composite value's children; its entry carries
+# the already encoded closing tag to append once every descendant has been written
+_CLOSE = object()
+
+
+# Marker placed just above a mapping's closing-tag entry; when it surfaces, the byte region
+# holding the mapping's fully written children gets remembered so that later appearances of
+# the very same object can replay the region instead of being rebuilt
+_RECORD = object()
+
+
+def _start_tag(key: str, datatype: str, index: typing.Optional[int], context: typing.Optional[tuple]) -> bytes:
+    """
+    Renders the opening tag for an element, resolving whether it is a list member
+
+    An element counts as a list member if its tag repeats among its mapping's children (those
+    get renumbered in document order) or if it arrived through a container (those keep the
+    position of the outermost container they came from)
 
-                    nodes = _build_element(slotted_variable, value)
+    :param key: The tag for the element
+    :param datatype: The name of the type of the value the element holds
+    :param index: The element's position within a containing list, if there was one
+    :param context: The (totals, counters) bookkeeping of the enclosing mapping, if there is one
+    :return: The encoded opening tag
+    """
+    if context is not None:
+        totals, counters = context
+        if totals.get(key, 0) > 1:
+            position = counters.get(key, 0)
+            counters[key] = position + 1
+            return f'<{key} datatype="{datatype}" list_member="{_TRUE}" index="{_index_text(position)}">'.encode("utf-8")
+
+    if index is not None:
+        return f'<{key} datatype="{datatype}" list_member="{_TRUE}" index="{_index_text(index)}">'.encode("utf-8")
+
+    opening = _START_TAG_CACHE.get((key, datatype))
+
+    if opening is None:
+        opening = _START_TAG_CACHE.setdefault(
+            (key, datatype),
+            f'<{key} datatype="{datatype}" list_member="{_FALSE}">'.encode("utf-8")
+        )
 
-                    for node in nodes:
-                        element.append(node)
+    return opening
 
-                elements.append(element)
+
+def _basic_branch(work, buf: bytearray, key: str, value: typing.Any, index: typing.Optional[int], context: typing.Optional[tuple], memo: dict) -> None:
+    """
+    Writes the complete element for an atomic value
+
+    :param work: The stack of pending nodes
+    :param buf: The buffer the document is being written into
+    :param key: The name of a presumed JSON node that contained the passed value
+    :param value: The atomic value alluded to by the key within the JSON document
+    :param index: The value's position within a containing list, if there was one
+    :param context: The duplicate-tag bookkeeping of the enclosing mapping, if there is one
+    """
+    value_type = type(value)
+    datatype = _TYPENAME_CACHE.get(value_type) or _TYPENAME_CACHE.setdefault(value_type, value_type.__name__)
+
+    if value_type is str:
+        text = escape(value)
+    elif value_type is int or value_type is float or value_type is bool or value is None:
+        # These render without any of the characters xml reserves, so skip the escape
+        text = str(value)
+    else:
+        text = escape(str(value))
+
+    buf += _start_tag(key, datatype, index, context)
+    buf += text.encode("utf-8")
+    buf += _closing_tag(key)
+
+
+def _mapping_branch(work, buf: bytearray, key: str, value: typing.Mapping, index: typing.Optional[int], context: typing.Optional[tuple], memo: dict) -> None:
+    """
+    Writes the opening tag for a mapping of keys to values and queues up its children
+
+    :param work: The stack of pending nodes
+    :param buf: The buffer the document is being written into
+    :param key: The name of a presumed JSON node that contained the passed value
+    :param value: The mapping alluded to by the key within the JSON document
+    :param index: The mapping's position within a containing list, if there was one
+    :param context: The duplicate-tag bookkeeping of the enclosing mapping, if there is one
+    """
+    # The passed in value was a JSON object - we'll need to translate that into a more complex xml mapping
+    """
+        ```
+        "key": {
+            "object1": 3,
+            "object2": [
+                3,
+                5,
+                6
+            ],
+            "object3": {
+                "object4": 5,
+                "object5": [
+                    1,
+                    2
+                    3
+                ],
+                "object6": "word"
+            }
+        }
+        ```
+
+        should end up looking like:
+
+        ```
+        <key>
+            <object1 datatype="int" list_member="false">3</object1>
+            <object2 datatype="int" list_member="true" index="0">3</object2>
+            <object2 datatype="int" list_member="true" index="1">5</object2>
+            <object2 datatype="int" list_member="true" index="3">6</object2>
+            <object3 datatype="dict" list_member="false">
+                <object4 datatype="int" list_member="false">5</object4>
+                <object5 datatype="int" list_member="true" index="0">1</object5>
+                <object5 datatype="int" list_member="true" index="1">2</object5>
+                <object5 datatype="int" list_member="true" index="2">3</object5>
+                <object6 datatype="str" list_member="false">word</object6>
+            </object3>
+        </key>
+        ```
+        """
+    value_type = type(value)
+    datatype = _TYPENAME_CACHE.get(value_type) or _TYPENAME_CACHE.setdefault(value_type, value_type.__name__)
+
+    # Large documents repeat identical metadata objects over and over; if this very object has
+    # already been written once, replay its children's bytes instead of walking it again
+    remembered = memo.get(id(value))
+
+    if remembered is not None:
+        buf += _start_tag(key, datatype, index, context)
+        buf += buf[remembered[0]:remembered[1]]
+        buf += _closing_tag(key)
+        return
+
+    buf += _start_tag(key, datatype, index, context)
+
+    # The closing tag goes in first so that it only surfaces once every child queued on top of
+    # it (and everything those children queue) has been written
+    work.append((_closing_tag(key), _CLOSE, None, None))
+
+    # The record marker sits just above it, so the remembered region covers exactly the
+    # children. Holding the object itself in the entry keeps its id from being recycled
+    work.append(((len(buf), id(value), value), _RECORD, None, None))
+
+    if type(value) is dict:
+        items = value.items()
+    else:
+        items = list(value.items())
+
+    # Duplicate tags under a dict can only come from containers flattening into multiple
+    # sibling elements; a dict whose children all produce exactly one element - the
+    # overwhelmingly common case - needs no duplicate bookkeeping at all. Mappings of other
+    # types can hand out repeated keys, so they always get the tally
+    needs_tally = type(value) is not dict
+
+    if not needs_tally:
+        for sub_key, sub_value in items:
+            if _handler_for(sub_value) is _container_branch and _collapsible_datatype(sub_value) is None:
+                needs_tally = True
+                break
+
+    if needs_tally:
+        # Tally how many elements each tag will produce - containers flatten into one element
+        # per leaf - so children know up front whether their tag repeats and needs renumbering
+        totals = {}
+        for sub_key, sub_value in items:
+            if _handler_for(sub_value) is _container_branch and _collapsible_datatype(sub_value) is None:
+                totals[sub_key] = totals.get(sub_key, 0) + _flattened_length(sub_value)
             else:
-                raise ValueError(f"Object of type '{type(value)}' ({str(value)}) cannot be converted to XML.")
+                totals[sub_key] = totals.get(sub_key, 0) + 1
+
+        child_context = (totals, {})
+    else:
+        child_context = None
+
+    # Queue children in reverse - the stack pops them back out in document order
+    for sub_key, sub_value in reversed(items):
+        work.append((sub_key, sub_value, None, child_context))
+
+
+def _container_branch(work, buf: bytearray, key: str, value: typing.Iterable, index: typing.Optional[int], context: typing.Optional[tuple], memo: dict) -> None:
+    """
+    Queues up the members of a container of values
+
+    Containers don't get elements of their own - each member becomes a sibling element bearing
+    the container's key, marked with its position within the container. Members of nested
+    containers inherit the position of the outermost container.
+
+    :param work: The stack of pending nodes
+    :param buf: The buffer the document is being written into
+    :param key: The name of a presumed JSON node that contained the passed value
+    :param value: The container alluded to by the key within the JSON document
+    :param index: The container's own position within a containing list, if there was one
+    :param context: The duplicate-tag bookkeeping of the enclosing mapping, if there is one
+    """
+    datatype = _collapsible_datatype(value)
+
+    if datatype is not None:
+        # The whole run of numbers packs into one element - structure-of-arrays instead of one
+        # element (and later one Python float) per number
+        opening = _start_tag(key, datatype, index, context)
+        buf += opening[:-1]
+        buf += f' length="{len(value)}">'.encode("utf-8")
+        buf += ",".join(map(str, value)).encode("utf-8")
+        buf += _closing_tag(key)
+        return
+
+    if not isinstance(value, (list, tuple)):
+        value = list(value)
+
+    for position in range(len(value) - 1, -1, -1):
+        work.append((key, value[position], index if index is not None else position, context))
+
+
+def _object_branch(work, buf: bytearray, key: str, value: typing.Any, index: typing.Optional[int], context: typing.Optional[tuple], memo: dict) -> None:
+    """
+    Writes the opening tag for an object that stores its members in its __dict__ and queues up its members
+
+    :param work: The stack of pending nodes
+    :param buf: The buffer the document is being written into
+    :param key: The name of a presumed JSON node that contained the passed value
+    :param value: The object alluded to by the key within the JSON document
+    :param index: The object's position within a containing list, if there was one
+    :param context: The duplicate-tag bookkeeping of the enclosing mapping, if there is one
+    """
+    value_type = type(value)
+    datatype = _TYPENAME_CACHE.get(value_type) or _TYPENAME_CACHE.setdefault(value_type, value_type.__name__)
+    buf += _start_tag(key, datatype, index, context)
+    work.append((_closing_tag(key), _CLOSE, None, None))
+
+    for sub_key, sub_value in reversed(list(value.__dict__.items())):
+        if callable(sub_value):
+            continue
+        work.append((sub_key, sub_value, None, None))
+
+
+def _slotted_branch(work, buf: bytearray, key: str, value: typing.Any, index: typing.Optional[int], context: typing.Optional[tuple], memo: dict) -> None:
+    """
+    Writes the opening tag for an object that stores its members as slot members and queues up its members
+
+    :param work: The stack of pending nodes
+    :param buf: The buffer the document is being written into
+    :param key: The name of a presumed JSON node that contained the passed value
+    :param value: The object alluded to by the key within the JSON document
+    :param index: The object's position within a containing list, if there was one
+    :param context: The duplicate-tag bookkeeping of the enclosing mapping, if there is one
+    """
+    keys: typing.Iterable[str] = value.__slots__
+    value_type = type(value)
+    datatype = _TYPENAME_CACHE.get(value_type) or _TYPENAME_CACHE.setdefault(value_type, value_type.__name__)
+    buf += _start_tag(key, datatype, index, context)
+    work.append((_closing_tag(key), _CLOSE, None, None))
+
+    for slotted_variable in reversed(list(keys)):
+        slotted_value = getattr(value, slotted_variable)
+
+        if callable(slotted_value):
+            continue
+
+        work.append((slotted_variable, slotted_value, None, None))
+
+
+def _unsupported_branch(work, buf: bytearray, key: str, value: typing.Any, index: typing.Optional[int], context: typing.Optional[tuple], memo: dict) -> None:
+    """
+    The branch for values that don't fit any of the recognized shapes
+
+    :param work: The stack of pending nodes
+    :param buf: The buffer the document is being written into
+    :param key: The name of a presumed JSON node that contained the passed value
+    :param value: The value that couldn't be translated
+    :param index: The value's position within a containing list, if there was one
+    :param context: The duplicate-tag bookkeeping of the enclosing mapping, if there is one
+    """
+    raise ValueError(f"Object of type '{type(value)}' ({str(value)}) cannot be converted to XML.")
+
+
+# Route the concrete types json.load produces straight to the right branch - a plain dict lookup
+# on the exact type is far cheaper than isinstance checks against the collections ABCs
+_DISPATCH: typing.Dict[type, typing.Callable] = {
+    dict: _mapping_branch,
+    list: _container_branch,
+    tuple: _container_branch,
+    str: _basic_branch,
+    int: _basic_branch,
+    float: _basic_branch,
+    bool: _basic_branch,
+    type(None): _basic_branch,
+}
+
+
+def _classify(value: typing.Any) -> typing.Callable:
+    """
+    Determines which branch handles the given value
+
+    This runs the hasattr/isinstance ladder, so it is only meant to be called once per type -
+    the result gets cached in the dispatch table. Which of these categories a class falls into
+    is a property of the class, not the instance, so caching by type is safe.
+
+    :param value: A value whose type isn't in the dispatch table yet
+    :return: The branch that handles values of this type
+    """
+    if _is_basic_value(value):
+        return _basic_branch
+    if isinstance(value, abstract_collections.Mapping):
+        return _mapping_branch
+    if _is_container(value):
+        return _container_branch
+    if hasattr(value, "__dict__"):
+        return _object_branch
+    if _is_slotted(value):
+        return _slotted_branch
+    return _unsupported_branch
+
+
+def _handler_for(value: typing.Any) -> typing.Callable:
+    """
+    Looks up the branch that handles the given value
+
+    The vast majority of nodes are routed with a single dict lookup on the exact type; the
+    first time an exotic type shows up it gets classified through the isinstance ladder and
+    the answer is memoized, so even those pay for the attribute probes only once
 
-            return elements
+    :param value: The value in need of a branch
+    :return: The branch that handles values of this type
+    """
+    value_type = type(value)
+    handler = _DISPATCH.get(value_type)
+
+    if handler is None:
+        handler = _DISPATCH.setdefault(value_type, _classify(value))
 
-        def _build_tree(data: typing.Dict[str, typing.Any]) -> etree.ElementBase:
-            tree = etree.Element("root")
+    return handler
 
-            for key, value in data.items():
-                nodes = _build_element(key, value)
-                for node in nodes:
-                    tree.append(node)
 
-            return tree
+# Packed integer runs come back out through numpy as int64 - anything beyond that range would
+# silently saturate, so such values must never be packed
+_INT64_MIN = -2 ** 63
+_INT64_MAX = 2 ** 63 - 1
 
-        def from_json(data: typing.Union[str, io.IOBase, dict]) -> etree.ElementBase:
-            if isinstance(data, io.IOBase):
-                data = json.load(data)
 
-            if isinstance(data, str):
-                data = json.loads(data)
+def _collapsible_datatype(value: typing.Any) -> typing.Optional[str]:
+    """
+    Determines whether a container can be emitted as a single packed numeric element
+
+    Containers holding nothing but real numbers - the bulk of measurement-heavy JSON - don't
+    need one element per number; the whole run can live in one element's text and be bulk
+    parsed on the way back out. Only offered when numpy is around to do that parsing.
+
+    :param value: The container being sized up
+    :return: The packed datatype to emit, or None if the container must be emitted member by member
+    """
+    if not numpy_is_available() or type(value) not in (list, tuple) or len(value) == 0:
+        return None
+
+    saw_float = False
+    for member in value:
+        member_type = type(member)
+        if member_type is float:
+            saw_float = True
+        elif member_type is not int:
+            return None
+        elif not (_INT64_MIN <= member <= _INT64_MAX):
+            # An integer too wide for int64 can't survive the bulk decode - emit the container
+            # member by member so the value stays exact
+            return None
 
-            return _build_tree(data)
+    return "float_list" if saw_float else "int_list"
+
+
+def _flattened_length(value: typing.Iterable) -> int:
+    """
+    Counts how many elements a container will flatten into
+
+    Containers don't get elements of their own, so members of nested containers all surface
+    as siblings - a count of a container's leaves is the number of elements it will produce
+
+    :param value: The container to measure
+    :return: The number of elements the container will produce
+    """
+    length = 0
+    pending = [value]
 
-        def from_json_file(path_or_buffer: typing.Union[str, io.IOBase]) -> etree.ElementBase:
-            if isinstance(path_or_buffer, str):
-                with open(path_or_buffer, 'r') as json_file:
-                    data = json.load(json_file)
+    while pending:
+        container = pending.pop()
+        if not isinstance(container, (list, tuple)):
+            container = list(container)
+
+        for member in container:
+            if _handler_for(member) is _container_branch and _collapsible_datatype(member) is None:
+                pending.append(member)
             else:
-                data = json.load(path_or_buffer)
+                length += 1
+
+    return length
+
+
+def _finalize_mapping(element: etree.ElementBase) -> None:
+    """
+    Resolves duplicate tags among a fully built mapping element's children
+
+    If a tag was encountered multiple times, we probably have a list that needs to be accounted
+    for - every element carrying that tag gets marked as a list member and indexed in order
 
-            return from_json(data)
+    :param element: The mapping element whose children have all been built
+    """
+    found_keys = {}
+    for node in element:
+        tag = node.tag
+        found_keys[tag] = found_keys.get(tag, 0) + 1
+
+    duplicated_tags = {tag for tag, count in found_keys.items() if count > 1}
+
+    # JSON object keys are usually all unique, in which case there's nothing to rewrite
+    if not duplicated_tags:
+        return
 
-        def query_from_json(data: typing.Union[str, io.IOBase, dict], path: str) -> typing.Sequence[etree.ElementBase]:
-            tree = from_json(data)
-            xpath_results = tree.xpath(path)
-            converted_results = _xml_to_json(xpath_results)
-            return converted_results
+    key_indices = {}
+    for node in element:
+        tag = node.tag
+        if tag in duplicated_tags:
+            position = key_indices.get(tag, 0)
+            node.set('list_member', _TRUE)
+            node.set('index', _index_text(position))
+            key_indices[tag] = position + 1
 
-        def query_from_json_file(data: typing.Union[str, io.IOBase], path: str) -> typing.Any:
-            tree = from_json_file(data)
-            xpath_results = tree.xpath(path)
-            converted_results = _xml_to_json(xpath_results)
 
-            if len(converted_results) == 1:
-                keys = [key for key in converted_results.keys()]
-                converted_results = converted_results[keys[0]]
-            elif numpy_is_available():
-                converted_results = numpy.array(converted_results)
+# One reusable set of scratch structures for the builder - the output buffer, the work stack, and
+# the subtree memo get cleared and reused instead of reallocated for every document. The lock keeps
+# concurrent builds from interleaving on them
+_BUILD_LOCK = Lock()
+_BUILD_BUFFER = bytearray()
+_WORK_STACK: deque = deque()
+_SUBTREE_MEMO: typing.Dict[int, tuple] = {}
 
-            return converted_results
 
-        def _xml_to_json(nodes: typing.Sequence[etree.ElementBase]) -> dict:
-            results = dict()
-            actual_values = dict()
+def _build_tree(data: typing.Dict[str, typing.Any]) -> etree.ElementBase:
+    """
+    Builds the queryable XML form of an already loaded JSON document
+
+    Rather than assembling the tree one lxml API call at a time - a Python-to-C crossing per
+    element and per attribute - the document is written out as XML bytes in a single pass and
+    parsed once. libxml2 assembles the whole tree internally at parser speed, which leaves
+    almost no per-node Python work at all.
 
-            for node in nodes:
-                if node.tag not in actual_values:
-                    actual_values[node.tag] = node
+    :param data: The loaded JSON document
+    :return: The root element of the built tree
+    """
+    with _BUILD_LOCK:
+        buf = _BUILD_BUFFER
+        buf.clear()
+        buf += b"<root>"
+
+        # Remembered children byte regions for mapping objects already written during this build,
+        # so repeated references to the same object replay bytes instead of being walked again
+        memo = _SUBTREE_MEMO
+        memo.clear()
+
+        # Drive the whole build off one explicit stack instead of recursing - no Python frame per
+        # node; composite values queue their children along with an entry for their closing tag
+        work = _WORK_STACK
+        work.clear()
+        for key, value in reversed(list(data.items())):
+            work.append((key, value, None, None))
+
+        while work:
+            key, value, index, context = work.pop()
+
+            if value is _CLOSE:
+                buf += key
+                continue
+
+            if value is _RECORD:
+                start, value_id, held = key
+                memo[value_id] = (start, len(buf), held)
+                continue
+
+            _handler_for(value)(work, buf, key, value, index, context, memo)
+
+        buf += b"</root>"
+        tree = etree.fromstring(bytes(buf))
+
+        # Don't let the scratch structures pin the document's bytes and objects between builds
+        buf.clear()
+        memo.clear()
+
+        return tree
+
+
+def _flush_buffered_members(frame: list) -> None:
+    """
+    Emits an array frame's buffered numeric members as ordinary expanded elements
+
+    Called when something disqualifies the array from packing - the members held back so far
+    get the elements they would have received had buffering never started - after which the
+    frame stops buffering for good
+
+    :param frame: The array frame whose buffer is being abandoned
+    """
+    for member in frame[5]:
+        member_type = type(member)
+        datatype = _TYPENAME_CACHE.get(member_type) or _TYPENAME_CACHE.setdefault(member_type, member_type.__name__)
+        index = frame[4] if frame[4] is not None else frame[3]
+        frame[3] += 1
+        element = etree.SubElement(frame[1], frame[2], {"datatype": datatype, "list_member": _TRUE, "index": _index_text(index)})
+        element.text = str(member)
+
+    frame[5] = None
+
+
+def _build_tree_from_events(events: typing.Iterable) -> etree.ElementBase:
+    """
+    Builds the XML tree straight from a stream of JSON parse events
+
+    This is the streaming twin of `_build_tree` - instead of walking an already loaded
+    dict/list graph, it consumes ijson's (event, value) pairs as the file is parsed, so the
+    intermediate Python object graph never exists. The emitted tree is identical to the one
+    the in-memory builder produces, including duplicate-tag resolution within objects and
+    position inheritance for nested arrays.
+
+    :param events: An iterable of (event, value) pairs as produced by ijson.basic_parse
+    :return: The root element of the built tree
+    """
+    tree = etree.Element("root")
+
+    # Each frame mirrors one open JSON object or array. Object frames carry the element
+    # children attach to, the key awaiting its value, and whether duplicate tags need to be
+    # resolved on close (the document root doesn't get that treatment, matching _build_tree).
+    # Array frames carry the element members attach to, the tag they share, the next member
+    # position, any position inherited from an enclosing array, and the numeric members held
+    # back for packing while the array still qualifies
+    frames: typing.List[list] = []
+
+    for event, value in events:
+        frame = frames[-1] if frames else None
+
+        if event == "map_key":
+            frame[2] = value
+        elif event in ("string", "number", "boolean", "null"):
+            value_type = type(value)
+            if frame[0] == "map":
+                datatype = _TYPENAME_CACHE.get(value_type) or _TYPENAME_CACHE.setdefault(value_type, value_type.__name__)
+                element = etree.SubElement(frame[1], frame[2], {"datatype": datatype, "list_member": _FALSE})
+            else:
+                # A run of nothing but real numbers packs into a single element, exactly as the
+                # in-memory builder does - hold the value back until the array closes or
+                # something disqualifies it from packing
+                if frame[5] is not None:
+                    if value_type is float or (value_type is int and _INT64_MIN <= value <= _INT64_MAX):
+                        frame[5].append(value)
+                        continue
+                    _flush_buffered_members(frame)
+
+                datatype = _TYPENAME_CACHE.get(value_type) or _TYPENAME_CACHE.setdefault(value_type, value_type.__name__)
+                index = frame[4] if frame[4] is not None else frame[3]
+                frame[3] += 1
+                element = etree.SubElement(frame[1], frame[2], {"datatype": datatype, "list_member": _TRUE, "index": _index_text(index)})
+            element.text = value if value_type is str else str(value)
+        elif event == "start_map":
+            if frame is None:
+                frames.append(["map", tree, None, False])
+            elif frame[0] == "map":
+                element = etree.SubElement(frame[1], frame[2], {"datatype": "dict", "list_member": _FALSE})
+                frames.append(["map", element, None, True])
+            else:
+                if frame[5] is not None:
+                    _flush_buffered_members(frame)
+                index = frame[4] if frame[4] is not None else frame[3]
+                frame[3] += 1
+                element = etree.SubElement(frame[1], frame[2], {"datatype": "dict", "list_member": _TRUE, "index": _index_text(index)})
+                frames.append(["map", element, None, True])
+        elif event == "end_map":
+            frame = frames.pop()
+            if frame[3]:
+                _finalize_mapping(frame[1])
+        elif event == "start_array":
+            if frame is None:
+                raise ValueError("Only a JSON object may sit at the top level of a queryable document.")
+            elif frame[0] == "map":
+                frames.append(["array", frame[1], frame[2], 0, None, [] if numpy_is_available() else None])
+            else:
+                if frame[5] is not None:
+                    _flush_buffered_members(frame)
+                index = frame[4] if frame[4] is not None else frame[3]
+                frame[3] += 1
+                frames.append(["array", frame[1], frame[2], 0, index, [] if numpy_is_available() else None])
+        elif event == "end_array":
+            frame = frames.pop()
+            if frame[5]:
+                members = frame[5]
+                saw_float = any(type(member) is float for member in members)
+                datatype = "float_list" if saw_float else "int_list"
+
+                if frame[4] is not None:
+                    attributes = {
+                        "datatype": datatype,
+                        "list_member": _TRUE,
+                        "index": _index_text(frame[4]),
+                        "length": str(len(members))
+                    }
                 else:
-                    if not isinstance(actual_values[node.tag], list):
-                        actual_values[node.tag] = [actual_values[node.tag]]
-                    actual_values[node.tag].append(node)
+                    attributes = {"datatype": datatype, "list_member": _FALSE, "length": str(len(members))}
+
+                element = etree.SubElement(frame[1], frame[2], attributes)
+                element.text = ",".join(map(str, members))
+
+    return tree
+
+
+def from_json(data: typing.Union[str, io.IOBase, dict]) -> etree.ElementBase:
+    if isinstance(data, io.IOBase):
+        data = _json.loads(data.read())
+
+    if isinstance(data, str):
+        data = _json.loads(data)
+
+    return _build_tree(data)
+
+
+def from_json_file(path_or_buffer: typing.Union[str, io.IOBase]) -> etree.ElementBase:
+    if isinstance(path_or_buffer, str):
+        # Given a path we control how the file is read, so stream it if ijson is around -
+        # the parse and the tree build become one pass and the intermediate dicts never exist
+        if ijson_is_available():
+            try:
+                with open(path_or_buffer, 'rb') as json_file:
+                    return _build_tree_from_events(ijson.basic_parse(json_file, use_float=True))
+            except ijson.common.IncompleteJSONError:
+                # ijson's C backend can't represent integers wider than 64 bits and aborts the
+                # parse on them. The accelerated parsers mangle such values too, so reread the
+                # file through the standard library's parser, which keeps them exact. Genuinely
+                # malformed documents fail there as well, with that parser's own error
+                with open(path_or_buffer, 'rb') as json_file:
+                    return from_json(json.loads(json_file.read()))
+
+        with open(path_or_buffer, 'rb') as json_file:
+            data = _json.loads(json_file.read())
+    else:
+        data = _json.loads(path_or_buffer.read())
+
+    return from_json(data)
 
-            list_nodes = [
-                (name, similar_nodes)
-                for name, similar_nodes in actual_values.items()
-                if isinstance(similar_nodes, list)
-            ]
 
-            for name, found_nodes in list_nodes:
-                for found_node in found_nodes:
-                    found_node.set("list_member", str(True))
+def query_from_json(data: typing.Union[str, io.IOBase, dict], path: str) -> typing.Sequence[etree.ElementBase]:
+    tree = from_json(data)
+    xpath_results = _compiled_xpath(path)(tree)
+    converted_results = _xml_to_json(xpath_results)
+    return converted_results
 
-                actual_values[name] = sorted(actual_values[name], key=lambda n: int(n.getparent().get("index", 0)))
 
-            for tag, value in actual_values.items():
-                if isinstance(value, list):
-                    results[tag] = list()
+def query_from_json_file(data: typing.Union[str, io.IOBase], path: str) -> typing.Any:
+    tree = from_json_file(data)
+    xpath_results = _compiled_xpath(path)(tree)
+    converted_results = _xml_to_json(xpath_results)
 
+    # _xml_to_json unwraps single-entry results itself, so a query resolving to one scalar
+    # arrives here as a bare value - only a dict still has a layer left to strip
+    if isinstance(converted_results, dict) and len(converted_results) == 1:
+        keys = [key for key in converted_results.keys()]
+        converted_results = converted_results[keys[0]]
+    else:
+        converted_results = _as_numeric_array(converted_results)
+
+    return converted_results
+
+
+def _as_numeric_array(values: typing.Any) -> typing.Any:
+    """
+    Converts a flat list of numbers into a numpy array, leaving anything else untouched
+
+    numpy.array on a dict or a mixed list runs a slow type-inference pass just to produce a
+    useless object array; only a homogeneous numeric list benefits from the conversion, and
+    for those fromiter with a known count allocates the exact buffer once. All-int lists stay
+    integers, and ones holding a value too wide for int64 are left alone entirely so the
+    exact Python ints survive
+
+    :param values: A converted query result
+    :return: The numpy form of the result if it is a flat numeric list, otherwise the result unchanged
+    """
+    if not numpy_is_available() or not isinstance(values, list) or len(values) == 0:
+        return values
+
+    saw_float = False
+    for member in values:
+        member_type = type(member)
+        if member_type is float:
+            saw_float = True
+        elif member_type is not int:
+            return values
+        elif not (_INT64_MIN <= member <= _INT64_MAX):
+            return values
+
+    return numpy.fromiter(values, dtype=numpy.float64 if saw_float else numpy.int64, count=len(values))
+
+
+def _xml_to_json(nodes: typing.Sequence[etree.ElementBase]) -> dict:
+    """
+    Converts queried XML elements back into the JSON-like values they were built from
+
+    Runs as an iterative post-order traversal over one explicit stack rather than recursing
+    per child: a 'convert' task translates one batch of sibling elements, queueing nested
+    batches into slots of its partially built result, and a 'finish' task - queued beneath
+    them so it only surfaces once they're all done - applies the single-result unwrapping
+
+    :param nodes: The elements a query matched
+    :return: The converted values
+    """
+    root_slot = [None]
+    stack: typing.List[tuple] = [("convert", list(nodes), root_slot, 0)]
+
+    while stack:
+        action, payload, container, slot = stack.pop()
+
+        if action == "finish":
+            if len(payload) == 1:
+                keys = [key for key in payload.keys()]
+                payload = payload[keys[0]]
+            else:
+                payload = _as_numeric_array(payload)
+
+            container[slot] = payload
+            continue
+
+        results = dict()
+
+        # Group every node under its tag in one pass - no membership probe, no wrap-on-collision
+        grouped = dict()
+        for node in payload:
+            grouped.setdefault(node.tag, []).append(node)
+
+        actual_values = dict()
+        for name, similar_nodes in grouped.items():
+            if len(similar_nodes) > 1:
+                # Decorate-sort-undecorate: read each node's parent index exactly once instead
+                # of paying two lxml calls and an int parse per comparison inside the sort
+                decorated = [
+                    (int(found_node.getparent().get("index", "0")), found_node)
+                    for found_node in similar_nodes
+                ]
+                decorated.sort(key=operator.itemgetter(0))
+
+                for _, found_node in decorated:
+                    found_node.set("list_member", _TRUE)
+
+                actual_values[name] = [found_node for _, found_node in decorated]
+            else:
+                actual_values[name] = similar_nodes[0]
+
+        # The finish task goes in first so that it only surfaces once every nested batch
+        # queued on top of it has been fully converted
+        stack.append(("finish", results, container, slot))
+
+        deferred = []
+
+        for tag, value in actual_values.items():
+            if isinstance(value, list):
+                # A run of nothing but numeric scalars can skip the per-element loop entirely:
+                # join the texts and let numpy parse the whole run in one C pass instead of
+                # building one Python float at a time
+                if numpy_is_available() and len(value) > 0:
+                    numeric = True
+                    saw_float = False
                     for element in value:
                         datatype = element.get("datatype", None)
-                        children = element.getchildren()
-                        if len(children) > 0:
-                            child_results = _xml_to_json(children)
-                            results[tag].append(child_results)
-                        elif datatype == 'float':
-                            results[tag].append(float(element.text))
-                        elif datatype == 'int':
-                            results[tag].append(float(element.text))
-                        else:
-                            results[tag].append(element.text)
-
-                    continue
-
-                datatype = value.get("database", "str")
-
-                if datatype == 'dict':
-                    child_nodes = value.getchildren()
-                    child_results = dict()
-                    for nested_node in child_nodes:
-                        nested_data = _xml_to_json([nested_node])
-                        child_results[tag] = nested_data
-                    results[tag] = child_results
-                elif datatype == 'float':
-                    results[tag] = float(value.text)
-                elif datatype == 'int':
-                    results[tag] = int(value.text)
-                else:
-                    results[tag] = value.text
+                        if datatype == 'float':
+                            saw_float = True
+                        elif datatype != 'int':
+                            numeric = False
+                            break
+                        elif len(element.text) > 18 and not (_INT64_MIN <= int(element.text) <= _INT64_MAX):
+                            # Too wide for the int64 bulk parse - the per-element loop below
+                            # builds exact Python ints instead. Anything with 18 digits or
+                            # fewer always fits, so the exact check only runs on outliers
+                            numeric = False
+                            break
+
+                    if numeric:
+                        results[tag] = numpy.fromstring(
+                            ",".join(element.text for element in value),
+                            dtype=numpy.float64 if saw_float else numpy.int64,
+                            sep=","
+                        )
+                        continue
+
+                members = list()
+                results[tag] = members
+
+                for element in value:
+                    datatype = element.get("datatype", None)
+                    children = element.getchildren()
+                    if len(children) > 0:
+                        members.append(None)
+                        deferred.append(("convert", children, members, len(members) - 1))
+                    elif datatype == 'float':
+                        members.append(float(element.text))
+                    elif datatype == 'int':
+                        members.append(int(element.text))
+                    elif datatype == 'float_list':
+                        members.append(numpy.fromstring(element.text, dtype=numpy.float64, sep=","))
+                    elif datatype == 'int_list':
+                        members.append(numpy.fromstring(element.text, dtype=numpy.int64, sep=","))
+                    elif datatype == 'str' and element.text is None:
+                        # An empty string can't survive the serialize-parse round trip intact
+                        members.append('')
+                    else:
+                        members.append(element.text)
+
+                continue
+
+            datatype = value.get("datatype", "str")
+
+            if datatype == 'dict':
+                child_results = dict()
+                results[tag] = child_results
+                for nested_node in value.getchildren():
+                    deferred.append(("convert", [nested_node], child_results, nested_node.tag))
+            elif datatype == 'float':
+                results[tag] = float(value.text)
+            elif datatype == 'int':
+                results[tag] = int(value.text)
+            elif datatype == 'float_list':
+                results[tag] = numpy.fromstring(value.text, dtype=numpy.float64, sep=",")
+            elif datatype == 'int_list':
+                results[tag] = numpy.fromstring(value.text, dtype=numpy.int64, sep=",")
+            elif datatype == 'str' and value.text is None:
+                results[tag] = ''
+            else:
+                results[tag] = value.text
+
+        # Reversed so the stack pops the batches back out in document order - where a tag
+        # repeats among a dict's children, the last one needs to land last
+        for task in reversed(deferred):
+            stack.append(task)
 
-            if len(results) == 1:
-                keys = [key for key in results.keys()]
-                results = results[keys[0]]
-            elif numpy_is_available():
-                results = numpy.array(results)
+    return root_slot[0]
 
-            return results
 
+def init() -> typing.NoReturn:
+    """
+    Attaches the json querying functions to lxml's etree
+
+    Kept for backward compatibility - the functions themselves now live at module scope, so
+    callers reach them without a C-module attribute lookup, but etree.from_json and friends
+    continue to work
+    """
+    # lock modification so (hopefully) nothing goofy happens out of order
+    with _INIT_LOCK:
         if not hasattr(etree, "from_json"):
             setattr(etree, "from_json", from_json)
 
@@ -331,21 +1030,21 @@ init()
 
 
 def xml_from_json(data: typing.Union[str, io.IOBase, dict]) -> etree.ElementBase:
-    return etree.from_json(data)
+    return from_json(data)
 
 
 def xml_from_json_file(path_or_buffer: typing.Union[str, io.IOBase]) -> etree.ElementBase:
-    return etree.from_json_file(path_or_buffer)
+    return from_json_file(path_or_buffer)
 
 
 def query(data: typing.Union[str, io.IOBase, dict], path: str) -> typing.Any:
     if isinstance(data, str) and os.path.exists(data):
-        with open(data) as data_file:
-            data = json.load(data_file)
+        with open(data, 'rb') as data_file:
+            data = _json.loads(data_file.read())
     elif isinstance(data, io.IOBase):
-        data = json.load(data)
+        data = _json.loads(data.read())
     elif isinstance(data, str):
-        data = json.loads(data)
+        data = _json.loads(data)
 
-    results = etree.query_from_json(data, path)
+    results = query_from_json(data, path)
     return results
@@ -15,6 +15,41 @@ class TestFileLoading(unittest.TestCase):
         print(results)
 
 
+class TestNumericQueries(unittest.TestCase):
+    def test_numeric_list_query(self):
+        results = jsonquery.query({"series": {"flow": [1.5, 2.5, 3.5]}}, "//flow")
+        self.assertEqual([float(member) for member in results], [1.5, 2.5, 3.5])
+
+    def test_numeric_list_query_from_file(self):
+        data_path = os.path.join(os.path.dirname(__file__), "resources", "numeric_series.json")
+        results = jsonquery.query_from_json_file(data_path, "//flow")
+        self.assertEqual([float(member) for member in results], [1.5, 2.5, 3.5])
+        results = jsonquery.query_from_json_file(data_path, "//count")
+        self.assertEqual([int(member) for member in results], [1, 2, 3])
+
+    def test_scalar_query_from_file(self):
+        data_path = os.path.join(os.path.dirname(__file__), "resources", "nwis_request.json")
+        result = jsonquery.query_from_json_file(data_path, "//latitude")
+        self.assertEqual(result, 38.94977778)
+
+    def test_numeric_run_query(self):
+        results = jsonquery.query({"items": [{"v": 1}, {"v": 2}, {"v": 3}]}, "//v")
+        self.assertEqual([int(member) for member in results], [1, 2, 3])
+
+    def test_wide_integers_from_file(self):
+        data_path = os.path.join(os.path.dirname(__file__), "resources", "numeric_series.json")
+        document = jsonquery.xml_from_json_file(data_path)
+        values = [int(node.text) for node in document.xpath("//big")]
+        self.assertEqual(values, [2 ** 70, 1])
+
+    def test_wide_integers_stay_exact(self):
+        results = jsonquery.query({"data": {"big": [2 ** 70, 1]}}, "//big")
+        self.assertEqual([int(member) for member in results], [2 ** 70, 1])
+
+        data_path = os.path.join(os.path.dirname(__file__), "resources", "numeric_series.json")
+        results = jsonquery.query_from_json_file(data_path, "//big")
+        self.assertEqual(list(results), [2 ** 70, 1])
+
 
 if __name__ == '__main__':
     unittest.main()